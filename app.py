@@ -1,46 +1,123 @@
 import os
-import tempfile
+import io
+import atexit
 import logging
+import logging.handlers
+import queue
 from dotenv import load_dotenv
 import asyncio
 import sys
-import difflib
-
-from telegram import Update, File
+import secrets
+import functools
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import httpx
+from rapidfuzz import fuzz, process
+from telegram import Update, File, MessageEntity
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     filters,
     ContextTypes,
 )
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 
 from src.agents import (
     prepare_conversation,
+    start_conversation,
     transcribe_voice,
     chat,
+    warmup,
+    has_conversation,
+    end_conversation,
+    restore_sessions,
 )
 
+if sys.platform != "win32":
+    import uvloop
+
+    # libuv-backed event loop for lower per-callback overhead
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 load_dotenv()
 
 
 def setup_logging():
-    """Configure structured logging with file and console output"""
+    """Configure structured logging with file and console output
+    
+    Handlers only enqueue records; a background listener thread does the
+    actual writes so the event loop never blocks on log I/O.
+    """
     os.makedirs("logs", exist_ok=True)
+
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler("logs/telegram_bot.log")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+    listener.start()
+    # Drain queued records to disk before the interpreter exits
+    atexit.register(listener.stop)
+
+    # Layout is applied by the listener's handlers; only render the message here
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
     
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler("logs/telegram_bot.log"),
-            logging.StreamHandler(sys.stdout)
-        ]
+        handlers=[queue_handler]
     )
     
     return logging.getLogger(__name__)
 
 # Command registry for suggestion feature
-AVAILABLE_COMMANDS = ["start", "new", "help"]
+AVAILABLE_COMMANDS = ("start", "new", "help")
+AVAILABLE_COMMANDS_SET = frozenset(AVAILABLE_COMMANDS)
+
+# Longer inputs are treated as garbage and not fuzzy-matched
+MAX_SUGGESTION_COMMAND_LENGTH = 20
+
+# User-facing error messages
+ERR_NETWORK = "Произошла временная ошибка в сети. Пожалуйста, попробуйте позже."
+ERR_QUERY = "Произошла ошибка при обработке вашего запроса."
+ERR_AUDIO = "Произошла ошибка при обработке аудио."
+ERR_VOICE_QUERY = "Произошла ошибка при обработке голосового запроса."
+
+# Supported audio MIME types and the file extension they are saved with
+EXTENSION_MAP = {
+    "audio/mpeg": ".mp3",
+    "audio/ogg": ".ogg",
+    "audio/mp4": ".m4a",
+    "audio/x-m4a": ".m4a",
+    "audio/wav": ".wav",
+}
+
+# Minimum seconds between streamed reply edits (Telegram allows ~1 edit/sec per chat)
+STREAM_EDIT_INTERVAL = 1.0
+
+# Large files are fetched as concurrent byte ranges; capped to stay clear of flood limits
+PARALLEL_DOWNLOAD_THRESHOLD = 5 * 1024 * 1024
+PARALLEL_DOWNLOAD_PARTS = 4
+# HTTP/1.1 with a connection per part: over HTTP/2 the ranges would share one TCP connection
+DOWNLOAD_CLIENT = httpx.AsyncClient(
+    http2=False,
+    limits=httpx.Limits(max_connections=4 * PARALLEL_DOWNLOAD_PARTS),
+    timeout=httpx.Timeout(60.0, connect=10.0),
+)
+
+# LRU cache of interview transcripts keyed by Telegram's stable file_unique_id
+TRANSCRIPT_CACHE_SIZE = 256
+TRANSCRIPT_CACHE: OrderedDict[str, str] = OrderedDict()
+
 
 logger = setup_logging()
 
@@ -49,6 +126,76 @@ if not TOKEN:
     logger.critical("TELEGRAM_BOT_TOKEN not found in environment variables!")
     sys.exit(1)
 
+# Webhook mode is used when set; otherwise fall back to polling for local development
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+
+PORT = int(os.getenv("PORT", 8443))
+
+# Random per-process path and header token so only Telegram can reach the webhook
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+async def notify(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str, **kwargs):
+    """Send a plain message to the chat"""
+    return await context.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+async def stream_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, user_query: str, user_id: int):
+    """Stream the chat reply into an existing message, then finalize it as HTML
+    
+    Partial edits are throttled to Telegram's one edit per second per chat and run
+    in the background, so a slow or failed edit never holds up or aborts the reply.
+    """
+    edit_task: asyncio.Task | None = None
+
+    async def edit_partial(text: str):
+        try:
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+        except TelegramError as e:
+            logger.debug("Skipped partial reply edit: %s", e)
+
+    async def on_partial(text: str):
+        nonlocal edit_task
+        if edit_task is not None and not edit_task.done():
+            return  # The previous edit is still in flight
+        edit_task = asyncio.create_task(edit_partial(text))
+
+    try:
+        response = await chat(
+            user_query, user_id, on_partial=on_partial, partial_interval=STREAM_EDIT_INTERVAL
+        )
+    finally:
+        # Let the last partial edit land first so it can't overwrite the final reply
+        if edit_task is not None:
+            await edit_task
+    if response:
+        try:
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=response,
+                parse_mode="HTML"
+            )
+        except BadRequest as e:
+            # The last partial edit may already show the full plain-text reply
+            if "not modified" not in str(e).lower():
+                raise
+    return response
+
+@dataclass(slots=True)
+class UserState:
+    """Per-user conversation state stored in context.user_data"""
+    chatting: bool = False
+    initial_query: str | None = None
+    warning_msg_id: int | None = None
+    unsupported_warning_msg_id: int | None = None
+    prep_task: asyncio.Task | None = None
+
+def get_user_state(context: ContextTypes.DEFAULT_TYPE) -> UserState:
+    """Return the user's state, creating it on first access"""
+    state = context.user_data.get("state")
+    if state is None:
+        state = context.user_data["state"] = UserState()
+    return state
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Initial greeting and instructions"""
     user_id = update.effective_user.id
@@ -65,8 +212,14 @@ async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     username = update.effective_user.username or "Unknown"
     logger.info(f"New conversation command received from User ID: {user_id}, Username: {username}")
     
+    # Stop an interview still being prepared, or it would recreate the conversation
+    prep_task = get_user_state(context).prep_task
+    if prep_task is not None:
+        prep_task.cancel()
+
     context.user_data.clear()
-    logger.debug(f"Cleared conversation state for User ID: {user_id}")
+    await end_conversation(user_id)
+    logger.debug("Cleared conversation state for User ID: %s", user_id)
     
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -91,16 +244,30 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         text=help_text
     )
 
+@functools.lru_cache(maxsize=512)
+def suggest_commands(command: str) -> tuple[str, ...]:
+    """Return up to three known commands similar to the given one"""
+    if not command or len(command) > MAX_SUGGESTION_COMMAND_LENGTH:
+        return ()
+    return tuple(
+        match for match, _, _ in process.extract(
+            command, AVAILABLE_COMMANDS, scorer=fuzz.ratio, limit=3, score_cutoff=60
+        )
+    )
+
 async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle unknown commands with fuzzy matching for suggestions"""
     user_id = update.effective_user.id
     username = update.effective_user.username or "Unknown"
     command = update.message.text.split()[0][1:]  # Remove the '/' prefix
     
+    if command in AVAILABLE_COMMANDS_SET:
+        return
+
     logger.warning(f"Unknown command '{command}' received from User ID: {user_id}, Username: {username}")
     
     # Find closest matching commands
-    possible_matches = difflib.get_close_matches(command, AVAILABLE_COMMANDS, n=3, cutoff=0.6)
+    possible_matches = suggest_commands(command.lower())
     
     if possible_matches:
         suggestion_text = f"Неизвестная команда: /{command}. Возможно, вы имели в виду:\n"
@@ -127,16 +294,23 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     # Only notify user if we can determine the chat
     if update and getattr(update, "effective_chat", None):
         try:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Произошла временная ошибка в сети. Пожалуйста, попробуйте позже."
-            )
+            await notify(context, update.effective_chat.id, ERR_NETWORK)
         except Exception:
             pass  # Silent failure if we can't even send an error message
 
 async def combined_audio_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Router for audio inputs: either initial interview or voice query"""
-    if context.user_data.get("chatting"):
+    state = get_user_state(context)
+
+    # Interview audio is still being prepared - wait for it so a voice query sent
+    # meanwhile isn't taken for a second interview
+    prep_task = state.prep_task
+    if prep_task is not None:
+        await asyncio.wait({prep_task})
+    prepared = prep_task is not None and not prep_task.cancelled() and prep_task.exception() is None
+
+    # A conversation restored after a restart counts as chat mode too
+    if state.chatting or prepared or has_conversation(update.effective_user.id):
         # Process as a voice query
         await handle_voice_query(update, context)
     else:
@@ -155,20 +329,72 @@ async def handle_unsupported_file(update: Update, context: ContextTypes.DEFAULT_
         text="Неподдерживаемый тип файла. Пожалуйста, отправьте аудиофайл с интервью или текстовое сообщение.",
     )
 
-    context.user_data["unsupported_warning_msg_id"] = warning_msg.message_id
+    get_user_state(context).unsupported_warning_msg_id = warning_msg.message_id
+
+async def prepare_and_cache(cache_key: str, audio_source, user_id: int):
+    """Prepare the conversation from audio and remember its transcript"""
+    transcript = await prepare_conversation(audio_source, user_id)
+    TRANSCRIPT_CACHE[cache_key] = transcript
+    if len(TRANSCRIPT_CACHE) > TRANSCRIPT_CACHE_SIZE:
+        TRANSCRIPT_CACHE.popitem(last=False)
+
+async def download_in_parts(url: str, size: int) -> bytes:
+    """Download a file as concurrent byte ranges and join them in order
+
+    The URL embeds the bot token, so errors raised here never include it.
+    """
+    part_size = -(-size // PARALLEL_DOWNLOAD_PARTS)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    try:
+        responses = await asyncio.gather(*(
+            DOWNLOAD_CLIENT.get(url, headers={"Range": f"bytes={start}-{end}"})
+            for start, end in ranges
+        ))
+    except httpx.HTTPError as e:
+        raise RuntimeError(f"Audio download failed: {type(e).__name__}") from None
+
+    for response, (start, end) in zip(responses, ranges):
+        if response.status_code == 200:
+            # Server ignored the Range header and sent the whole file
+            if len(response.content) != size:
+                raise RuntimeError(f"Audio download truncated: {len(response.content)} of {size} bytes")
+            return response.content
+        if response.status_code != 206:
+            raise RuntimeError(f"Audio download failed: HTTP {response.status_code}")
+        content_range = response.headers.get("Content-Range", "")
+        if content_range.split("/")[0] != f"bytes {start}-{end}" or len(response.content) != end - start + 1:
+            raise RuntimeError(f"Audio download returned a bad part for bytes {start}-{end}")
+
+    return b"".join(response.content for response in responses)
+
+async def download_audio(media, extension: str) -> io.BytesIO:
+    """Download Telegram audio straight into a named in-memory file object"""
+    audio_file: File = await media.get_file()
+    logger.info(f"Downloading audio into memory: {media.file_unique_id}")
+
+    file_size = audio_file.file_size or 0
+    if file_size > PARALLEL_DOWNLOAD_THRESHOLD and audio_file.file_path.startswith("https://"):
+        audio_bytes = await download_in_parts(audio_file.file_path, file_size)
+    else:
+        audio_bytes = await audio_file.download_as_bytearray()
+
+    audio_source = io.BytesIO(audio_bytes)
+    audio_source.name = f"audio{extension}"
+    return audio_source
 
 async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process initial interview audio to establish conversation context
     
     This function:
-    1. Downloads the audio to a temporary file
+    1. Downloads the audio into memory
     2. Passes it to the conversation preparation module
     3. Processes any queued initial query if present
     """
-    file_path = None
-    processed_successfully = False
-    user_id = update.effective_user.id
-    username = update.effective_user.username or "Unknown"
+    user = update.effective_user
+    user_id = user.id
+    username = user.username or "Unknown"
+    chat_id = update.effective_chat.id
+    state = get_user_state(context)
     
     logger.info(f"Audio received from User ID: {user_id}, Username: {username}")
 
@@ -179,180 +405,171 @@ async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return
 
+    prep_task = None
     try:
-        audio_file: File = await media.get_file()
-        
-        logger.debug(f"Audio details - File ID: {media.file_id}, MIME Type: {media.mime_type}, File Size: {media.file_size} bytes")
+        logger.debug("Audio details - File ID: %s, MIME Type: %s, File Size: %s bytes", media.file_id, media.mime_type, media.file_size)
 
-        # Ensure user-specific download directory exists
-        downloads_dir = os.path.join("downloads", str(user_id))
-        os.makedirs(downloads_dir, exist_ok=True)
-        
         # Determine file extension from MIME type
         mime_type = media.mime_type
-        extension_map = {
-            "audio/mpeg": ".mp3",
-            "audio/ogg": ".ogg",
-            "audio/mp4": ".m4a",
-            "audio/x-m4a": ".m4a",
-            "audio/wav": ".wav",
-        }
-        extension = extension_map.get(mime_type)
+        extension = EXTENSION_MAP.get(mime_type)
         
         if not extension:
             logger.warning(f"Unsupported audio format: {mime_type} from User ID: {user_id}")
             await context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Неподдерживаемый формат аудио.",
             )
             return
 
-        # Create and use temporary file
-        with tempfile.NamedTemporaryFile(suffix=extension, delete=False, dir=downloads_dir) as temp_file:
-            file_path = temp_file.name
-        
-        logger.info(f"Downloading audio to: {file_path}")
-        download_task = asyncio.create_task(audio_file.download_to_drive(file_path))
-        await download_task
-
         # Remove any previous warnings if needed
-        if context.user_data.get("unsupported_warning_msg_id"):
+        if state.unsupported_warning_msg_id:
             try:
                 await context.bot.delete_message(
-                    chat_id=update.effective_chat.id,
-                    message_id=context.user_data["unsupported_warning_msg_id"],
+                    chat_id=chat_id,
+                    message_id=state.unsupported_warning_msg_id,
                 )
                 logger.info("Deleted unsupported file warning message")
             except Exception as ex:
                 logger.error(f"Could not delete unsupported warning message: {str(ex)}")
 
-            context.user_data.pop("unsupported_warning_msg_id", None)
+            state.unsupported_warning_msg_id = None
 
         # Process the audio
-        status_message = await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Аудио получено. Обрабатываю..."
+        status_coro = context.bot.send_message(
+            chat_id=chat_id, text="Аудио получено. Обрабатываю..."
         )
 
-        logger.info(f"Starting conversation preparation with audio file: {file_path}")
-        await prepare_conversation(file_path)
-        logger.info("Conversation preparation completed successfully")
+        # Reuse the transcript if this exact audio was processed before
+        cache_key = media.file_unique_id
+        transcript = TRANSCRIPT_CACHE.get(cache_key)
+        if transcript is not None:
+            TRANSCRIPT_CACHE.move_to_end(cache_key)
+            logger.info(f"Reusing cached transcript for file unique ID: {cache_key}")
+            status_message = await status_coro
+        else:
+            # Download while the status message is being sent
+            audio_source, status_message = await asyncio.gather(
+                download_audio(media, extension), status_coro
+            )
 
-        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=status_message.message_id)
+        # Prepare the conversation in the background so queries can wait on it
+        if transcript is not None:
+            logger.info("Starting conversation preparation with cached transcript")
+            prep_task = asyncio.create_task(start_conversation(transcript, user_id))
+        else:
+            logger.info("Starting conversation preparation with downloaded audio")
+            prep_task = asyncio.create_task(prepare_and_cache(cache_key, audio_source, user_id))
+        state.prep_task = prep_task
 
         # Handle any pending query
-        pending_query = update.message.caption if update.message.caption else context.user_data.get("initial_query")
+        pending_query = update.message.caption if update.message.caption else state.initial_query
         if pending_query:
             # Clean up previous warning messages if needed
-            if context.user_data.get("warning_msg_id"):
+            if state.warning_msg_id:
                 try:
                     await context.bot.delete_message(
-                        chat_id=update.effective_chat.id, 
-                        message_id=context.user_data["warning_msg_id"]
+                        chat_id=chat_id, 
+                        message_id=state.warning_msg_id
                     )
                 except Exception as ex:
                     logger.error(f"Could not delete warning message: {str(ex)}")
-                context.user_data.pop("warning_msg_id", None)
+                state.warning_msg_id = None
                 
-            context.user_data["initial_query"] = pending_query
+            state.initial_query = pending_query
+
+            await prep_task
+            logger.info("Conversation preparation completed successfully")
 
-            logger.info(f"Processing initial query for User ID: {user_id}: {pending_query[:50]}...")
-            query_status = await context.bot.send_message(
-                chat_id=update.effective_chat.id,
+            # Reuse the status message for progress and the final answer
+            logger.info("Processing initial query for User ID: %s: %.50s...", user_id, pending_query)
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=status_message.message_id,
                 text="Аудио обработано. Обрабатываю ваш запрос...",
             )
             try:
-                response = await chat(pending_query)
+                response = await stream_chat(context, chat_id, status_message.message_id, pending_query, user_id)
                 if response:
-                    await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=query_status.message_id)
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=response,
-                        parse_mode="HTML"
-                    )
-                    processed_successfully = True
                     logger.info(f"Successfully processed initial query for User ID: {user_id}")
             except Exception as e:
                 logger.error(f"Error during initial chat for User ID: {user_id}: {str(e)}", exc_info=True)
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Произошла ошибка при обработке вашего запроса.",
-                )
+                await notify(context, chat_id, ERR_QUERY)
         else:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
+            await prep_task
+            logger.info("Conversation preparation completed successfully")
+
+            await context.bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=status_message.message_id,
                 text="Аудио обработано. Можете задавать вопросы.",
             )
-            processed_successfully = True
 
         # Enable chat mode
-        context.user_data["chatting"] = True
-        context.user_data.pop("initial_query", None)
-
+        state.chatting = True
+        state.initial_query = None
+
+    except asyncio.CancelledError:
+        # /new discarded this interview while it was being prepared; anything else is a real cancel
+        if prep_task is None or not prep_task.cancelled():
+            raise
+        logger.info(f"Conversation preparation cancelled by /new for User ID: {user_id}")
     except Exception as e:
         logger.error(f"Error processing audio for User ID: {user_id}: {str(e)}", exc_info=True)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Произошла ошибка при обработке аудио.",
-        )
+        await notify(context, chat_id, ERR_AUDIO)
     finally:
-        # Clean up temporary file
-        if processed_successfully and file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logger.debug(f"Removed temporary file: {file_path}")
-            except Exception as remove_error:
-                logger.error(f"Failed to remove temporary file {file_path}: {str(remove_error)}", exc_info=True)
+        state.prep_task = None
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process text queries in chat mode or queue them for later processing"""
-    user_id = update.effective_user.id
-    username = update.effective_user.username or "Unknown"
+    user = update.effective_user
+    user_id = user.id
+    username = user.username or "Unknown"
+    chat_id = update.effective_chat.id
     user_query = update.message.text
+    state = get_user_state(context)
+
+    # Audio is still being prepared - wait for it rather than queueing the query
+    prep_task = state.prep_task
+    if prep_task is not None:
+        await asyncio.wait({prep_task})
+    prepared = prep_task is not None and not prep_task.cancelled() and prep_task.exception() is None
     
-    if context.user_data.get("chatting"):
+    # A conversation restored after a restart counts as chat mode too
+    if state.chatting or prepared or has_conversation(user_id):
         # Chat mode - process query immediately
-        logger.info(f"Processing text query from User ID: {user_id}, Username: {username}: {user_query[:50]}...")
+        logger.info("Processing text query from User ID: %s, Username: %s: %.50s...", user_id, username, user_query)
     
         processing_msg = await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Обрабатываю ваш запрос..."
+            chat_id=chat_id, text="Обрабатываю ваш запрос..."
         )
         try:
-            response = await chat(user_query)
+            response = await stream_chat(context, chat_id, processing_msg.message_id, user_query, user_id)
             if response:
-                logger.debug(f"Response generated for User ID: {user_id}, Response length: {len(response)}")
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=processing_msg.message_id)
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=response,
-                    parse_mode="HTML"
-                )
+                logger.debug("Response generated for User ID: %s, Response length: %d", user_id, len(response))
                 logger.info(f"Response sent to User ID: {user_id}")
         except Exception as e:
             logger.error(f"Error during chat for User ID: {user_id}: {str(e)}", exc_info=True)
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Произошла ошибка при обработке вашего запроса.",
-            )
+            await notify(context, chat_id, ERR_QUERY)
     else:
         # Queue query for later processing after audio is received
         logger.warning(f"User ID: {user_id} attempted to send a query before audio was received")
         
-        if "initial_query" not in context.user_data:
+        if state.initial_query is None:
             # First query before audio
-            context.user_data["initial_query"] = user_query
+            state.initial_query = user_query
             warning_msg = await context.bot.send_message(
-                chat_id=update.effective_chat.id,
+                chat_id=chat_id,
                 text="Аудио ещё не получено. Ваш запрос сохранён и будет обработан после получения аудио."
             )
-            context.user_data["warning_msg_id"] = warning_msg.message_id
+            state.warning_msg_id = warning_msg.message_id
         else:
             # Additional queries before audio
-            context.user_data["initial_query"] += "\n" + user_query
-            if "warning_msg_id" in context.user_data:
+            state.initial_query += "\n" + user_query
+            if state.warning_msg_id is not None:
                 try:
                     await context.bot.edit_message_text(
-                        chat_id=update.effective_chat.id,
-                        message_id=context.user_data["warning_msg_id"],
+                        chat_id=chat_id,
+                        message_id=state.warning_msg_id,
                         text="Аудио ещё не получено. Ваш запрос сохранён и будет обработан после получения аудио."
                     )
                 except Exception as e:
@@ -366,8 +583,10 @@ async def handle_voice_query(update: Update, context: ContextTypes.DEFAULT_TYPE)
     2. Transcribes it using the voice transcription service
     3. Processes the transcribed text as a chat query
     """
-    user_id = update.effective_user.id
-    username = update.effective_user.username or "Unknown"
+    user = update.effective_user
+    user_id = user.id
+    username = user.username or "Unknown"
+    chat_id = update.effective_chat.id
     logger.info(f"Voice query received from User ID: {user_id}, Username: {username}")
 
     # Get the voice or audio media object
@@ -375,73 +594,96 @@ async def handle_voice_query(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not media:
         return
 
-    # Set up temporary file
-    extension = ".ogg"  # Default for Telegram voice messages
-    downloads_dir = os.path.join("downloads", str(user_id))
-    os.makedirs(downloads_dir, exist_ok=True)
-
-    with tempfile.NamedTemporaryFile(suffix=extension, delete=False, dir=downloads_dir) as temp_file:
-        file_path = temp_file.name
+    extension = EXTENSION_MAP.get(media.mime_type, ".ogg")  # Default for Telegram voice messages
 
     try:
         # Download and transcribe the voice message
-        audio_file: File = await media.get_file()
-        logger.info(f"Downloading voice query to: {file_path}")
-        await audio_file.download_to_drive(file_path)
+        audio_source = await download_audio(media, extension)
 
         logger.info(f"Transcribing voice query")
-        transcribed_text = await transcribe_voice(file_path)
+        transcribed_text = await transcribe_voice(audio_source)
         logger.info(f"Transcription result: {transcribed_text}")
 
         # Process the transcribed text
         processing_msg = await context.bot.send_message(
-            chat_id=update.effective_chat.id, text="Обрабатываю ваш запрос..."
+            chat_id=chat_id, text="Обрабатываю ваш запрос..."
         )
         try:
-            response = await chat(transcribed_text)
-            if response:
-                await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=processing_msg.message_id)
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=response,
-                    parse_mode="HTML",
-                )
+            await stream_chat(context, chat_id, processing_msg.message_id, transcribed_text, user_id)
         except Exception as e:
             logger.error(f"Error during chat for UserID: {user_id}: {str(e)}", exc_info=True)
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="Произошла ошибка при обработке вашего запроса.",
-            )
+            await notify(context, chat_id, ERR_QUERY)
     except Exception as e:
         logger.error(f"Error processing voice query for UserID: {user_id}: {str(e)}", exc_info=True)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Произошла ошибка при обработке голосового запроса.",
-        )
-    finally:
-        # Clean up temporary file
-        if os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-                logger.debug(f"Removed temporary file: {file_path}")
-            except Exception as remove_error:
-                logger.error(f"Failed to remove temporary file {file_path}: {str(remove_error)}", exc_info=True)
+        await notify(context, chat_id, ERR_VOICE_QUERY)
+
+async def dispatch_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route every non-command update to its handler by message content type"""
+    message = update.message
+    if message is None:
+        return
+
+    if message.text:
+        entities = message.entities
+        if entities and entities[0].type == MessageEntity.BOT_COMMAND and entities[0].offset == 0:
+            await unknown_command(update, context)
+        else:
+            await handle_text(update, context)
+    elif message.audio or message.voice:
+        await combined_audio_handler(update, context)
+    elif message.photo or message.video or message.document:
+        await handle_unsupported_file(update, context)
+
+async def post_init(application):
+    """Restore saved conversations and warm up the OpenAI connection before the first update arrives"""
+    try:
+        restored = await restore_sessions()
+        logger.info(f"Restored {restored} conversation sessions")
+    except Exception as e:
+        logger.error(f"Could not restore conversation sessions: {str(e)}", exc_info=True)
+
+    try:
+        await warmup()
+        logger.info("OpenAI connection warmed up")
+    except Exception as e:
+        logger.warning(f"OpenAI warmup failed: {str(e)}")
+
+async def post_shutdown(application):
+    """Close the audio download client once the bot has stopped"""
+    await DOWNLOAD_CLIENT.aclose()
 
 def main():
     """Entry point: configure and start the Telegram bot"""
     logger.info("Starting Telegram bot application")
     try:
-        application = ApplicationBuilder().token(TOKEN).build()
+        # Pace Bot API calls against Telegram's flood limits instead of retrying on 429
+        rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3)
+        # Larger HTTP/2 pool so concurrent Bot API calls don't queue for a connection
+        request = HTTPXRequest(
+            connection_pool_size=64,
+            pool_timeout=5.0,
+            connect_timeout=5.0,
+            read_timeout=20.0,
+            http_version="2",
+        )
+        application = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .request(request)
+            .rate_limiter(rate_limiter)
+            # Let slow transcription/chat updates run alongside other users' updates
+            .concurrent_updates(256)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+            .build()
+        )
 
         # Register handlers in priority order
         handlers = [
             CommandHandler("start", start),
             CommandHandler("new", new),
             CommandHandler("help", help),
-            MessageHandler(filters.AUDIO | filters.VOICE, combined_audio_handler),
-            MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text),
-            MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, handle_unsupported_file),
-            MessageHandler(filters.COMMAND, unknown_command)  # Must be last
+            MessageHandler(filters.ALL, dispatch_message)  # Must be last
         ]
         
         for handler in handlers:
@@ -450,8 +692,18 @@ def main():
         # Register global error handler
         application.add_error_handler(error_handler)
 
-        logger.info("All handlers registered, starting polling...")
-        application.run_polling()
+        if WEBHOOK_URL:
+            logger.info(f"All handlers registered, starting webhook on port {PORT}...")
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=WEBHOOK_SECRET,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_SECRET}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            logger.warning("WEBHOOK_URL not set, falling back to polling")
+            application.run_polling()
     except Exception as e:
         logger.critical(f"Failed to start the bot: {str(e)}", exc_info=True)
         sys.exit(1)
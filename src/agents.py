@@ -1,6 +1,25 @@
 import io
+import os
+import time
+import logging
+import re
+import html
+import asyncio
+import functools
+import hashlib
+import heapq
+import json
+import math
+import sqlite3
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from itertools import chain
+from pathlib import Path
+from typing import Awaitable, BinaryIO, Callable
 
 import aiofiles
+import httpx
+import tiktoken
 
 from dotenv import load_dotenv
 from openai import AsyncOpenAI
@@ -8,189 +27,985 @@ from openai import AsyncOpenAI
 
 load_dotenv()
 
-client = AsyncOpenAI()
+logger = logging.getLogger(__name__)
 
-conversation_history = []
+# One shared client with a large keep-alive pool so concurrent users don't queue
+# for connections; long transcriptions keep the SDK's default 10 minute timeout
+client = AsyncOpenAI(
+    http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100, keepalive_expiry=120),
+        http2=True,
+        timeout=httpx.Timeout(600.0, connect=10.0),
+    )
+)
+
+# Recent user/assistant turn pairs sent verbatim; once SUMMARY_INTERVAL_TURNS more have
+# piled up, the older ones are folded into a running summary in a single call
+HISTORY_WINDOW_TURNS = 6
+SUMMARY_INTERVAL_TURNS = 4
+
+# Recent turns are also folded into the summary once their approximate size
+# (about four characters per token) exceeds this budget, however few they are
+HISTORY_TOKEN_BUDGET = 6000
+
+def approximate_tokens(text: str) -> int:
+    """Returns a cheap estimate of the token count of the text."""
+    return len(text) // 4
+
+async def warmup():
+    """
+    Opens and keeps alive a connection to the OpenAI API with a cheap request, so the
+    first user query doesn't pay for the TCP and TLS handshakes.
+    """
+    await client.models.list()
+
+@dataclass
+class Session:
+    """
+    A user's conversation about one interview.
+
+    Attributes:
+        prefix (tuple[dict, ...]): System prompt and transcript messages. Never mutated,
+            so it stays byte-identical across turns for OpenAI prompt caching.
+        turns (deque): Recent user/assistant messages within the history window.
+        summary (str | None): Summary of turns that fell out of the window.
+        transcript_key (str | None): Hash of the transcript, keying the reply cache.
+        lock (asyncio.Lock): Serializes turns so concurrent queries don't interleave.
+        tokens (int): Approximate token count of the recent turns. The prefix is never
+            evicted, so it isn't counted.
+    """
+    prefix: tuple[dict, ...] = ()
+    turns: deque = field(default_factory=deque)
+    summary: str | None = None
+    transcript_key: str | None = None
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+    tokens: int = field(init=False, default=0)
+
+    def __post_init__(self):
+        self.tokens = sum(approximate_tokens(message["content"]) for message in self.turns)
+
+    def append_turn(self, message: dict):
+        """Appends a message to the recent turns, keeping the token count current."""
+        self.turns.append(message)
+        self.tokens += approximate_tokens(message["content"])
+
+    def pop_oldest_turn(self) -> dict:
+        """Removes and returns the oldest recent message, keeping the token count current."""
+        message = self.turns.popleft()
+        self.tokens -= approximate_tokens(message["content"])
+        return message
+
+    def context(self) -> list[dict]:
+        """Returns the model input for the next turn: prefix, summary and recent turns."""
+        summary_messages = (
+            [{"role": "system", "content": f"Earlier summary: {self.summary}"}] if self.summary else []
+        )
+        return list(chain(self.prefix, summary_messages, self.turns))
+
+# Conversation sessions keyed by Telegram user ID
+sessions: dict[int, Session] = {}
+
+# Replies to earlier queries per transcript, looked up by query embedding similarity
+RESPONSE_CACHE_SIMILARITY = 0.92
+RESPONSE_CACHE_TRANSCRIPTS = 256
+RESPONSE_CACHE_ENTRIES = 128
+response_caches: OrderedDict[str, list[tuple[list[float], str]]] = OrderedDict()
+
+INTERVIEW_TRANSCRIPTION_PROMPT = (
+    "The following conversation is a US embassy interview between a US embassy officer "
+    "and an applicant.\n\n"
+    "Return like this following this format:\n\n"
+    "Output:\n"
+    "Interviewer: <response>\n"
+    "Applicant: <response>\n"
+    "Interviewer: <response>\n"
+    "Applicant: <response>\n"
+    "..."
+)
+
+VOICE_QUERY_TRANSCRIPTION_PROMPT = (
+    "Transcribe as it is clearly. Incoming audio files are in Russian, Uzbek, and English languages."
+)
+
+# Static conversation prefix around the transcript; kept byte-identical across
+# sessions so OpenAI can reuse the cached prompt prefix
+SYSTEM_MESSAGE = (
+    "You are a US embassy expert interview officer assistant. Based on the following interview transcript, "
+    "summarize, make in-depth interview assessment and answer any follow-up questions the user has about the interview.\n"
+    "\n"
+    "**Supported languages**\n"
+    "you can speak answer in Russian, Uzbek (both Latin & Cyrillic), and English\n"
+    "\t- e.i,. if user query comes in EN => respond in EN\n"
+    "\t- e.i., if user query comes in RU => respond in RU alphabet: абс\n"
+    "\t-e.i., if user query comes in UZ => you have two options: Latin: abc; Cyrillic: абсд; so depends on user query.\n"
+    "Always follow above language instruction unless user specifies in his user query (then override and follow their instruction.)\n"
+    "\n"
+    ""
+    "**Edge cases**\n"
+    "\n"
+    "\t- user might pass query / instruction so u can in this case override system instruction and follow thier instructions up to given criteria and threshhold.\n"
+)
+
+ASSISTANT_ACK = "Ask anything about interview..."
+
+# Transcripts longer than this are summarized once so every chat turn stays small
+TRANSCRIPT_TOKEN_BUDGET = 4000
+encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+
+# Summarized transcripts are also split into overlapping token windows, embedded once;
+# each query gets its most similar windows in a separate message after the cached prefix
+TRANSCRIPT_WINDOW_TOKENS = 800
+TRANSCRIPT_WINDOW_OVERLAP = 100
+TRANSCRIPT_EXCERPTS = 3
+TRANSCRIPT_INDEX_ENTRIES = 64
+transcript_indexes: OrderedDict[str, tuple[str, list[tuple[list[float], str]]]] = OrderedDict()
+
+# Tags Telegram's HTML parse mode accepts; everything else in a reply is escaped
+ALLOWED_HTML_TAGS = re.compile(
+    r'</?(?:b|i|u|s|pre)>|<code(?:\s+class="[^"<>]*")?>|</code>|<a\s+href="[^"<>]*">|</a>'
+)
+
+# Markdown the model emits, converted to Telegram HTML in Python rather than by the model:
+# headings and **bold** become <b>, *italic* becomes <i>, and list markers become bullets
+MARKDOWN_HEADING = re.compile(r"^[ \t]*#{1,6}[ \t]+(.+?)[ \t#]*$", re.MULTILINE)
+MARKDOWN_BULLET = re.compile(r"^([ \t]*)[-*+][ \t]+", re.MULTILINE)
+MARKDOWN_BOLD = re.compile(r"\*\*(.+?)\*\*")
+MARKDOWN_ITALIC = re.compile(r"(?<![*\w])\*(?![\s*])([^*\n]+?)(?<!\s)\*(?![*\w])")
+
+# Recordings at least this large are split into chunks of about TRANSCRIPTION_CHUNK_MS
+# at silences and transcribed concurrently, at most TRANSCRIPTION_CONCURRENCY at a time
+CHUNKED_TRANSCRIPTION_MIN_BYTES = 2 * 1024 * 1024
+TRANSCRIPTION_CHUNK_MS = 60_000
+TRANSCRIPTION_CONCURRENCY = 8
+SILENCE_SEEK_STEP_MS = 50
+transcription_semaphore = asyncio.Semaphore(TRANSCRIPTION_CONCURRENCY)
+
+# Interview transcriptions keyed by a hash of the whole recording and prompt, shared on disk
+# across processes and restarts; the least recently used entries are dropped past
+# TRANSCRIPTION_CACHE_ENTRIES. Voice queries never repeat, so they aren't cached
+TRANSCRIPTION_CACHE_PATH = Path(os.getenv("TRANSCRIPTION_CACHE_PATH", "cache/transcriptions.sqlite3"))
+TRANSCRIPTION_CACHE_ENTRIES = 10_000
+
+# Sessions are saved here after every turn and restored at startup, so a restart
+# doesn't force users to re-upload and re-transcribe their interview. Sessions idle
+# longer than SESSION_TTL_SECONDS are deleted, as are all but the most recent
+# SESSION_STORE_ENTRIES, so transcripts don't pile up on disk or in memory
+SESSION_STORE_PATH = Path(os.getenv("SESSION_STORE_PATH", "cache/sessions.sqlite3"))
+SESSION_TTL_SECONDS = 30 * 24 * 60 * 60
+SESSION_STORE_ENTRIES = 10_000
+session_store_lock = asyncio.Lock()
+
+# Files below this size are read in a worker thread; aiofiles only pays off for larger ones
+SMALL_AUDIO_FILE_SIZE = 1024 * 1024
 
-async def prepare_conversation(audio_file_path: str):
+async def prepare_conversation(audio_file_path: str | bytes | BinaryIO, user_id: int):
     """
     Transcribes the given audio, and then initializes the conversation history with
     system instructions and initial context messages.
 
     Args:
-        audio_file_path (str): The path to the audio file to transcribe.
+        audio_file_path (str | bytes | BinaryIO): The path to the audio file to transcribe,
+            raw OGG audio bytes, or an in-memory file object with a ``name`` carrying
+            its extension.
+        user_id (int): The Telegram user the conversation belongs to.
+
+    Returns:
+        str: The full interview transcript, so callers can cache it.
     """
     transcript = await transcribe_audio(audio_file_path)
-    system_message = (
-        "You are a US embassy expert interview officer assistant. Based on the following interview transcript, "
-        "summarize, make in-depth interview assessment and answer any follow-up questions the user has about the interview.\n"
-        "\n"
-        "**Supported languages**\n"
-        "you can speak answer in Russian, Uzbek (both Latin & Cyrillic), and English\n"
-        "\t- e.i,. if user query comes in EN => respond in EN\n"
-        "\t- e.i., if user query comes in RU => respond in RU alphabet: абс\n"
-        "\t-e.i., if user query comes in UZ => you have two options: Latin: abc; Cyrillic: абсд; so depends on user query.\n"
-        "Always follow above language instruction unless user specifies in his user query (then override and follow their instruction.)\n"
-        "\n"
-        ""
-        "**Edge cases**\n"
-        "\n"
-        "\t- user might pass query / instruction so u can in this case override system instruction and follow thier instructions up to given criteria and threshhold.\n"
-        "\n"
-        "**Formatting Output**\n"
-        "for instance not like **Main Points** but retun like this 1. <b> First Point</b> ... to all of points apply this."
-        "return All output is sent to telegram bot. Format bold points or any headings with html tags <b></b> instead of **.\n"
+    await start_conversation(transcript, user_id)
+    return transcript
+
+async def condense_transcript(transcript: str, transcript_key: str):
+    """
+    Summarizes the transcript once if it exceeds the token budget, so the summary
+    rather than the full transcript is resent on every chat turn, and indexes
+    overlapping windows of the full text so queries can still reach its details.
+
+    Args:
+        transcript (str): The full interview transcript.
+        transcript_key (str): Hash of the transcript, keying its index.
+
+    Returns:
+        str: The transcript itself, or its summary if it was too long.
+    """
+    indexed = transcript_indexes.get(transcript_key)
+    if indexed is not None:
+        transcript_indexes.move_to_end(transcript_key)
+        return indexed[0]
+
+    tokens = encoding.encode(transcript)
+    if len(tokens) <= TRANSCRIPT_TOKEN_BUDGET:
+        return transcript
+
+    # The summary alone is enough to chat, so window indexing is best-effort
+    summary, windows = await asyncio.gather(
+        summarize_transcript(transcript), embed_transcript_windows(tokens), return_exceptions=True
+    )
+    if isinstance(summary, BaseException):
+        raise summary
+    if isinstance(windows, BaseException):
+        logger.warning(f"Indexing transcript windows failed, continuing with the summary only: {str(windows)}")
+        windows = []
+    transcript_indexes[transcript_key] = (summary, windows)
+    if len(transcript_indexes) > TRANSCRIPT_INDEX_ENTRIES:
+        transcript_indexes.popitem(last=False)
+    return summary
+
+async def embed_transcript_windows(tokens: list[int]) -> list[tuple[list[float], str]]:
+    """
+    Splits the tokenized transcript into overlapping windows and embeds them in one request.
+
+    Args:
+        tokens (list[int]): The transcript encoded with ``encoding``.
+
+    Returns:
+        list[tuple[list[float], str]]: Each window's normalized embedding and text,
+            in transcript order.
+    """
+    step = TRANSCRIPT_WINDOW_TOKENS - TRANSCRIPT_WINDOW_OVERLAP
+    windows = [
+        encoding.decode(tokens[start:start + TRANSCRIPT_WINDOW_TOKENS])
+        for start in range(0, max(len(tokens) - TRANSCRIPT_WINDOW_OVERLAP, 1), step)
+    ]
+    embeddings = await embed_batch(windows)
+    return list(zip(embeddings, windows))
+
+def lookup_transcript_excerpts(transcript_key: str, query_embedding: list[float]) -> list[str]:
+    """
+    Finds the transcript windows most similar to the query.
+
+    Args:
+        transcript_key (str): Hash of the transcript the conversation is about.
+        query_embedding (list[float]): The normalized embedding of the query.
+
+    Returns:
+        list[str]: Up to TRANSCRIPT_EXCERPTS windows in transcript order, or an empty
+            list if the transcript was short enough to be sent whole.
+    """
+    indexed = transcript_indexes.get(transcript_key)
+    if indexed is None:
+        return []
+    windows = indexed[1]
+
+    best = heapq.nlargest(
+        TRANSCRIPT_EXCERPTS,
+        range(len(windows)),
+        key=lambda i: sum(a * b for a, b in zip(windows[i][0], query_embedding)),
+    )
+    return [windows[i][1] for i in sorted(best)]
 
+async def summarize_transcript(transcript: str):
+    """
+    Summarizes a long transcript, keeping every question and answer.
+
+    Args:
+        transcript (str): The full interview transcript.
+
+    Returns:
+        str: The summary.
+    """
+    response = await client.responses.create(
+        model="gpt-4o-mini",
+        input=[{
+            "role": "system",
+            "content": (
+                "Summarize this US embassy interview transcript preserving all factual claims, "
+                "every question the officer asked and the applicant's answers."
+            )
+        },
+        {
+            "role": "user",
+            "content": transcript
+        }],
+        stream=False
     )
-    global conversation_history
+    return response.output_text
+
+async def start_conversation(transcript: str, user_id: int):
+    """
+    Initializes the conversation history with system instructions and the given
+    interview transcript (condensed if it is over the token budget), skipping transcription.
+
+    Args:
+        transcript (str): A previously produced interview transcript.
+        user_id (int): The Telegram user the conversation belongs to.
+    """
+    transcript_key = hashlib.sha256(transcript.encode()).hexdigest()
+    condensed = await condense_transcript(transcript, transcript_key)
+
     # Clear any previous conversation and initialize the chat context.
-    conversation_history = [{
-        "role": "system",
-        "content": system_message
-    },
-    {
-        "role": "user",
-        "content": f"Interview transcript as the context: \n{transcript}"
-    },
-    {
-        "role": "assistant",
-        "content": "Ask anything about interview..."
-    }]
+    sessions[user_id] = Session(
+        prefix=({
+            "role": "system",
+            "content": SYSTEM_MESSAGE
+        },
+        {
+            "role": "user",
+            "content": f"Interview transcript as the context: \n{condensed}"
+        },
+        {
+            "role": "assistant",
+            "content": ASSISTANT_ACK
+        }),
+        transcript_key=transcript_key,
+    )
+    await persist_session(user_id, sessions[user_id])
+
+def has_conversation(user_id: int) -> bool:
+    """Returns whether the user has a conversation about an interview to continue."""
+    return user_id in sessions
+
+async def end_conversation(user_id: int):
+    """
+    Forgets the user's conversation, in memory and on disk.
+
+    Args:
+        user_id (int): The Telegram user whose conversation ends.
+    """
+    sessions.pop(user_id, None)
+    try:
+        async with session_store_lock:
+            await asyncio.to_thread(delete_stored_session, user_id)
+    except sqlite3.Error as e:
+        logger.warning(f"Could not delete stored session for User ID {user_id}: {str(e)}")
+
+async def persist_session(user_id: int, session: Session):
+    """
+    Saves the session to disk unless it has since been ended or replaced, so a reply
+    finishing after /new doesn't write the old conversation back. Failures are logged,
+    never raised, so a broken store doesn't cost the user their reply.
+
+    Args:
+        user_id (int): The Telegram user the session belongs to.
+        session (Session): The session to save.
+    """
+    data = json.dumps({
+        "prefix": session.prefix,
+        "turns": list(session.turns),
+        "summary": session.summary,
+        "transcript_key": session.transcript_key,
+    })
+    async def write():
+        async with session_store_lock:
+            if sessions.get(user_id) is not session:
+                return
+            await asyncio.to_thread(store_session, user_id, data)
+
+    try:
+        # Shielded so a cancelled caller can't release the lock, and let end_conversation
+        # delete the row, while the write is still running in its thread
+        await asyncio.shield(write())
+    except sqlite3.Error as e:
+        logger.warning(f"Could not persist session for User ID {user_id}: {str(e)}")
+
+async def restore_sessions() -> int:
+    """
+    Loads the sessions saved by earlier runs, keeping any already started in this one.
+
+    Returns:
+        int: The number of sessions restored.
+    """
+    stored = await asyncio.to_thread(load_stored_sessions)
+    restored = 0
+    for user_id, data in stored.items():
+        if user_id not in sessions:
+            sessions[user_id] = Session(
+                prefix=tuple(data["prefix"]),
+                turns=deque(data["turns"]),
+                summary=data["summary"],
+                transcript_key=data["transcript_key"],
+            )
+            restored += 1
+    return restored
+
+def open_session_store() -> sqlite3.Connection:
+    """
+    Opens the on-disk session store, creating it in WAL mode if needed.
+
+    Returns:
+        sqlite3.Connection: A new connection; the caller closes it.
+    """
+    SESSION_STORE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(SESSION_STORE_PATH, timeout=10)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS sessions "
+        "(user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+    )
+    # Stores created before the timestamp column existed get it with 0, so those rows expire
+    columns = {row[1] for row in connection.execute("PRAGMA table_info(sessions)")}
+    if "updated_at" not in columns:
+        connection.execute("ALTER TABLE sessions ADD COLUMN updated_at REAL NOT NULL DEFAULT 0")
+    return connection
+
+def prune_stored_sessions(connection: sqlite3.Connection):
+    """Deletes expired sessions and all but the most recently updated SESSION_STORE_ENTRIES."""
+    connection.execute(
+        "DELETE FROM sessions WHERE updated_at < ?", (time.time() - SESSION_TTL_SECONDS,)
+    )
+    connection.execute(
+        "DELETE FROM sessions WHERE user_id NOT IN "
+        "(SELECT user_id FROM sessions ORDER BY updated_at DESC LIMIT ?)",
+        (SESSION_STORE_ENTRIES,),
+    )
+
+def store_session(user_id: int, data: str):
+    """Writes a serialized session and prunes old ones. Blocking; run it in a worker thread."""
+    connection = open_session_store()
+    try:
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (user_id, data, time.time())
+            )
+            prune_stored_sessions(connection)
+    finally:
+        connection.close()
+
+def delete_stored_session(user_id: int):
+    """Removes a serialized session. Blocking; run it in a worker thread."""
+    connection = open_session_store()
+    try:
+        with connection:
+            connection.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+    finally:
+        connection.close()
+
+def load_stored_sessions() -> dict[int, dict]:
+    """Prunes old sessions and reads the rest. Blocking; run it in a worker thread."""
+    connection = open_session_store()
+    try:
+        with connection:
+            prune_stored_sessions(connection)
+        rows = connection.execute("SELECT user_id, data FROM sessions").fetchall()
+    finally:
+        connection.close()
+    return {user_id: json.loads(data) for user_id, data in rows}
 
 #=== US Embassy Interview Assistant Agent ===#
-async def chat(user_query: str):
+async def chat(
+    user_query: str,
+    user_id: int,
+    on_partial: Callable[[str], Awaitable[None]] | None = None,
+    partial_interval: float = 0.0,
+):
     """
     Sends the user query (prefixed by a predefined text) appended to the conversation history,
     then calls the model and returns the assistant's reply.
 
     Args:
         user_query (str): The user's query about the interview.
+        user_id (int): The Telegram user whose conversation the query belongs to.
+        on_partial (Callable[[str], Awaitable[None]] | None): If given, the reply is streamed
+            and this is awaited with the plain text received so far.
+        partial_interval (float): Minimum seconds between on_partial calls, so the text
+            is only joined as often as the caller can use it.
 
     Returns:
         str: The assistant's full response text.
     """
+    session = sessions.setdefault(user_id, Session())
 
-    # Append the user query with the specified format.
-    conversation_history.append({
-        "role": "user",
-        "content": f"Here is user query: \n{user_query}"
-    })
+    # One turn at a time per user, so concurrent queries can't interleave their messages
+    async with session.lock:
+        history = session.turns
+
+        # Fold turns that fell out of the window into the summary, only every few turns
+        # so the summary message (and the cached prefix before it) stays stable, or as
+        # soon as long turns push the history over its token budget
+        if (
+            len(history) >= 2 * (HISTORY_WINDOW_TURNS + SUMMARY_INTERVAL_TURNS)
+            or session.tokens > HISTORY_TOKEN_BUDGET
+        ):
+            # Pick the oldest turns to fold in, but only drop them once the summary
+            # succeeded, so a failed summary call doesn't lose them
+            remaining_turns = len(history)
+            remaining_tokens = session.tokens
+            evicted = []
+            for message in history:
+                if remaining_turns <= 2 * HISTORY_WINDOW_TURNS and remaining_tokens <= HISTORY_TOKEN_BUDGET:
+                    break
+                evicted.append(message)
+                remaining_turns -= 1
+                remaining_tokens -= approximate_tokens(message["content"])
+            try:
+                session.summary = await summarize_turns(session.summary, evicted)
+            except Exception as e:
+                # Answer with the longer history this time; the next turn tries again
+                logger.warning(f"Summarizing history failed for User ID {user_id}: {str(e)}")
+            else:
+                for _ in evicted:
+                    session.pop_oldest_turn()
+
+        # The embedding only feeds the reply cache (opening questions) and excerpt retrieval
+        # (indexed transcripts), so it's skipped otherwise, and a failure here degrades to
+        # an uncached reply rather than failing the turn
+        opening_question = not session.turns and session.summary is None
+        query_embedding = None
+        if session.transcript_key is not None and (
+            opening_question or session.transcript_key in transcript_indexes
+        ):
+            try:
+                query_embedding = await embed(user_query)
+            except Exception as e:
+                logger.warning(f"Query embedding failed for User ID {user_id}: {str(e)}")
+
+        # Answer semantically repeated questions about the same transcript from the cache.
+        # Only opening questions are cached: a follow-up like "tell me more" depends on
+        # the conversation, which the cache key doesn't capture
+        cacheable = query_embedding is not None and opening_question
+        if cacheable:
+            cached_reply = lookup_cached_reply(session.transcript_key, query_embedding)
+            if cached_reply is not None:
+                session.append_turn({"role": "user", "content": f"Here is user query: \n{user_query}"})
+                session.append_turn({"role": "assistant", "content": cached_reply})
+                await persist_session(user_id, session)
+                return sanitize_html(cached_reply)
+
+        # Append the user query with the specified format.
+        session.append_turn({
+            "role": "user",
+            "content": f"Here is user query: \n{user_query}"
+        })
+
+        stream = on_partial is not None
+
+        # Relevant parts of a summarized transcript go just before the query, after
+        # everything cacheable, and are not kept in the history
+        model_input = session.context()
+        if query_embedding is not None:
+            excerpts = lookup_transcript_excerpts(session.transcript_key, query_embedding)
+            if excerpts:
+                model_input.insert(-1, {
+                    "role": "system",
+                    "content": "Relevant transcript excerpts:\n\n" + "\n...\n".join(excerpts)
+                })
+
+        # Call the model and get response
+        response = await client.responses.create(
+            model="gpt-4o-mini",
+            input=model_input,
+            stream=stream,
+            # Route every turn of this conversation to the same cached prefix
+            extra_body={"prompt_cache_key": f"interview-{user_id}"}
+        )
+
+        if not stream:
+            assistant_reply = response.output_text
+        else:
+            # Accumulate assistant's response text as it arrives; joined only when needed
+            reply_parts = []
+            loop = asyncio.get_running_loop()
+            last_partial = loop.time()
+            async for event in response:
+                delta = getattr(event, "delta", None)
+                if delta:
+                    reply_parts.append(delta)
+                    # Call back once per interval, not per token
+                    if loop.time() - last_partial >= partial_interval:
+                        last_partial = loop.time()
+                        # Tags may still be unclosed mid-stream, so partial text is sent without them
+                        partial_reply = "".join(reply_parts)
+                        await on_partial(ALLOWED_HTML_TAGS.sub("", markdown_to_html(partial_reply)))
+            assistant_reply = "".join(reply_parts)
+
+        # Append the assistant's full reply to the conversation history.
+        if assistant_reply:
+            session.append_turn({
+                "role": "assistant",
+                "content": assistant_reply
+            })
+            if cacheable:
+                store_cached_reply(session.transcript_key, query_embedding, assistant_reply)
+            await persist_session(user_id, session)
+
+            return sanitize_html(assistant_reply)
+
+
+async def embed(text: str) -> list[float]:
+    """
+    Embeds the text and normalizes it to unit length, so a dot product is the cosine similarity.
+
+    Args:
+        text (str): The text to embed.
+
+    Returns:
+        list[float]: The normalized embedding.
+    """
+    return (await embed_batch([text]))[0]
+
+
+async def embed_batch(texts: list[str]) -> list[list[float]]:
+    """
+    Embeds several texts in one request, normalizing each to unit length.
+
+    Args:
+        texts (list[str]): The texts to embed.
+
+    Returns:
+        list[list[float]]: The normalized embeddings, in the same order as the texts.
+    """
+    response = await client.embeddings.create(model="text-embedding-3-small", input=texts)
+    embeddings = []
+    for item in sorted(response.data, key=lambda item: item.index):
+        vector = item.embedding
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        embeddings.append([value / norm for value in vector])
+    return embeddings
+
+
+def lookup_cached_reply(transcript_key: str, query_embedding: list[float]) -> str | None:
+    """
+    Finds the cached reply whose query is most similar to the given one.
+
+    Args:
+        transcript_key (str): Hash of the transcript the conversation is about.
+        query_embedding (list[float]): The normalized embedding of the new query.
+
+    Returns:
+        str | None: The cached reply if its query is similar enough, otherwise None.
+    """
+    entries = response_caches.get(transcript_key)
+    if not entries:
+        return None
+    response_caches.move_to_end(transcript_key)
+
+    best_similarity, best_reply = max(
+        ((sum(a * b for a, b in zip(embedding, query_embedding)), reply) for embedding, reply in entries),
+        key=lambda item: item[0],
+    )
+    return best_reply if best_similarity >= RESPONSE_CACHE_SIMILARITY else None
+
+
+def store_cached_reply(transcript_key: str, query_embedding: list[float], reply: str):
+    """
+    Remembers a reply for semantically similar queries about the same transcript.
+
+    Args:
+        transcript_key (str): Hash of the transcript the conversation is about.
+        query_embedding (list[float]): The normalized embedding of the query.
+        reply (str): The assistant's reply to the query.
+    """
+    entries = response_caches.setdefault(transcript_key, [])
+    response_caches.move_to_end(transcript_key)
+    entries.append((query_embedding, reply))
+    if len(entries) > RESPONSE_CACHE_ENTRIES:
+        entries.pop(0)
+    if len(response_caches) > RESPONSE_CACHE_TRANSCRIPTS:
+        response_caches.popitem(last=False)
+
+
+async def summarize_turns(summary: str | None, turns: list[dict]):
+    """
+    Condenses older conversation turns, together with any previous summary, into a
+    single summary.
+
+    Args:
+        summary (str | None): The summary of even earlier turns, if any.
+        turns (list[dict]): The user/assistant messages being dropped from the window.
+
+    Returns:
+        str: The updated summary.
+    """
+    earlier = f"Previous summary:\n{summary}\n\n" if summary else ""
+    dialogue = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
 
-    # Call the model and get response
     response = await client.responses.create(
         model="gpt-4o-mini",
-        input=conversation_history,
-        stream=False # set to 'True' if u want to stream
+        input=[{
+            "role": "system",
+            "content": (
+                "Condense this earlier part of a conversation about a US embassy interview into "
+                "a short summary that keeps every fact, question and conclusion."
+            )
+        },
+        {
+            "role": "user",
+            "content": f"{earlier}Conversation:\n{dialogue}"
+        }],
+        stream=False
     )
+    return response.output_text
 
-    # Accumulate assistant's response text as it arrives.
-    # assistant_reply = ""
-    # async for event in response:
-    #     if hasattr(event, "delta") and event.delta:
-    #         # print(event.delta, end="", flush=True)
-    #         assistant_reply += event.delta
-
-    # print("\n" + "-" * 20)
-    # Append the assistant's full reply to the conversation history.
-    
-    if response:
-        # print(response.output_text)
-        conversation_history.append({
-            "role": "assistant",
-            "content": response.output_text
-        })
 
-        return response.output_text
+def sanitize_html(text: str) -> str:
+    """
+    Escapes everything in the text except Telegram-supported HTML tags, so the reply
+    parses on the first send instead of failing with a BadRequest, and converts the
+    Markdown the model writes into those tags.
+
+    Args:
+        text (str): The model's reply.
+
+    Returns:
+        str: The reply with stray ``<``, ``>`` and ``&`` escaped and Markdown converted.
+    """
+    parts = []
+    last_end = 0
+    for match in ALLOWED_HTML_TAGS.finditer(text):
+        parts.append(html.escape(text[last_end:match.start()], quote=False))
+        parts.append(match.group(0))
+        last_end = match.end()
+    parts.append(html.escape(text[last_end:], quote=False))
+    return markdown_to_html("".join(parts))
+
+def markdown_to_html(text: str) -> str:
+    """
+    Converts Markdown headings, bold, italics and list markers to Telegram HTML.
 
+    Args:
+        text (str): Text that may contain Markdown.
+
+    Returns:
+        str: The text with headings and bold as ``<b>``, italics as ``<i>`` and
+            ``-``/``*`` list markers as bullets.
+    """
+    # Headings are bold already, so bold inside them is dropped rather than nested
+    text = MARKDOWN_HEADING.sub(lambda match: f"<b>{match.group(1).replace('**', '')}</b>", text)
+    text = MARKDOWN_BULLET.sub("\\1• ", text)
+    text = MARKDOWN_BOLD.sub(r"<b>\1</b>", text)
+    return MARKDOWN_ITALIC.sub(r"<i>\1</i>", text)
 
 # === Audio Transcriber Agent ===#
-async def transcribe_audio(audio_file_path: str):
+async def read_audio_file(audio_file_path: str) -> io.BytesIO:
     """
-    Transcribes the audio from the given file path using OpenAI's transcription API.
+    Reads an audio file into a named in-memory stream without blocking the event loop.
 
     Args:
         audio_file_path (str): The path to the audio file.
 
     Returns:
-        str: The transcribed text from the audio file.
+        io.BytesIO: The file contents, named after the file so its format can be detected.
     """
-    # Read the file asynchronously into memory
-    async with aiofiles.open(audio_file_path, "rb") as afile:
-        file_bytes = await afile.read()
+    path = Path(audio_file_path)
+    if (await asyncio.to_thread(path.stat)).st_size < SMALL_AUDIO_FILE_SIZE:
+        file_bytes = await asyncio.to_thread(path.read_bytes)
+    else:
+        async with aiofiles.open(audio_file_path, "rb") as afile:
+            file_bytes = await afile.read()
 
     file_stream = io.BytesIO(file_bytes)
-    file_stream.name = audio_file_path
-
-    with open(audio_file_path, "rb") as audio_file:
-        # start = time.time()
-        transcription = await client.audio.transcriptions.create(
-            model="gpt-4o-mini-transcribe", # gpt-4o-mini-transcribe, gpt-4o-transcribe
-            file=audio_file,
-            prompt= (
-                        "The following conversation is a US embassy interview between a US embassy officer "
-                        "and an applicant.\n\n"
-                        "Return like this following this format:\n\n"
-                        "Output:\n"
-                        "Interviewer: <response>\n"
-                        "Applicant: <response>\n"
-                        "Interviewer: <response>\n"
-                        "Applicant: <response>\n"
-                        "..."
-                    ),
-    stream=False # set to True to stream
+    file_stream.name = os.path.basename(audio_file_path)
+    return file_stream
+
+async def transcribe(audio_file_path: str | bytes | BinaryIO, prompt: str):
+    """
+    Transcribes the audio from the given file path using OpenAI's transcription API.
+
+    Args:
+        audio_file_path (str | bytes | BinaryIO): The path to the audio file, raw OGG
+            audio bytes (e.g. a Telegram voice message), or an in-memory file object
+            with a ``name`` carrying its extension.
+        prompt (str): Instructions guiding the transcription model.
+
+    Returns:
+        str: The transcribed text from the audio file.
+    """
+    if isinstance(audio_file_path, str):
+        file_stream = await read_audio_file(audio_file_path)
+    elif isinstance(audio_file_path, (bytes, bytearray)):
+        # Upload straight from memory with an explicit name and type
+        file_stream = ("audio.ogg", bytes(audio_file_path), "audio/ogg")
+    else:
+        file_stream = audio_file_path
+
+    start = time.perf_counter()
+    transcription = await client.audio.transcriptions.create(
+        model="gpt-4o-mini-transcribe", # gpt-4o-mini-transcribe, gpt-4o-transcribe
+        file=file_stream,
+        prompt=prompt,
+        stream=False # set to True to stream
     )
-    # end = time.time()
-    # full_text = ""
-    # async for event in transcription:
-    #     # If the event is a delta event, append its delta to full_text
-    #     if hasattr(event, "delta"):
-    #         # You can print the token as it arrives or accumulate it
-    #         print(event.delta, end="", flush=True)
-    #         full_text += event.delta
-
-    # print("\n")
-    # print("-" * 25)
-    # print(f"Time taken: {end-start} seconds")
-    
+    # Measured once the full text is in, not when the request was merely sent
+    logger.info("Transcription took %.2f seconds", time.perf_counter() - start)
+
     return transcription.text
 
-async def transcribe_voice(audio_file):
+def open_transcription_cache() -> sqlite3.Connection:
+    """
+    Opens the on-disk transcription cache, creating it in WAL mode so several bot
+    processes can read and write it concurrently.
 
+    Returns:
+        sqlite3.Connection: A new connection; the caller closes it.
     """
-    Transcribes the audio from the given file path using OpenAI's transcription API.
+    TRANSCRIPTION_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(TRANSCRIPTION_CACHE_PATH, timeout=10)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS transcriptions "
+        "(key TEXT PRIMARY KEY, text TEXT NOT NULL, used_at REAL NOT NULL)"
+    )
+    return connection
+
+def lookup_cached_transcription(cache_key: str) -> str | None:
+    """
+    Returns the cached transcription for the key, marking it as recently used.
+    Blocking; run it in a worker thread.
 
     Args:
-        audio_file (str): The path to the audio file.
+        cache_key (str): Hash of the audio bytes and the transcription prompt.
 
     Returns:
-        str: The transcribed text from the audio file.
+        str | None: The cached text, or None on a miss.
     """
-    # Read the file asynchronously into memory
-    async with aiofiles.open(audio_file, "rb") as afile:
-        file_bytes = await afile.read()
+    connection = open_transcription_cache()
+    try:
+        with connection:
+            row = connection.execute(
+                "SELECT text FROM transcriptions WHERE key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE transcriptions SET used_at = ? WHERE key = ?", (time.time(), cache_key)
+            )
+            return row[0]
+    finally:
+        connection.close()
 
-    file_stream = io.BytesIO(file_bytes)
-    file_stream.name = audio_file
-
-    with open(audio_file, "rb") as audio_file:
-        # start = time.time()
-        transcription = await client.audio.transcriptions.create(
-            model="gpt-4o-mini-transcribe", # gpt-4o-mini-transcribe, gpt-4o-transcribe
-            file=audio_file,
-            prompt= (
-                        "Transcribe as it is clearly. Incoming audio files are in Russian, Uzbek, and English languages."
-                    ),
-    stream=False # set to True to stream
+def store_cached_transcription(cache_key: str, text: str):
+    """
+    Stores a transcription and evicts the least recently used entries over the limit.
+    Blocking; run it in a worker thread.
+
+    Args:
+        cache_key (str): Hash of the audio bytes and the transcription prompt.
+        text (str): The transcribed text.
+    """
+    connection = open_transcription_cache()
+    try:
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO transcriptions VALUES (?, ?, ?)", (cache_key, text, time.time())
+            )
+            connection.execute(
+                "DELETE FROM transcriptions WHERE key NOT IN "
+                "(SELECT key FROM transcriptions ORDER BY used_at DESC LIMIT ?)",
+                (TRANSCRIPTION_CACHE_ENTRIES,),
+            )
+    finally:
+        connection.close()
+
+def split_audio(audio_bytes: bytes) -> list[bytes]:
+    """
+    Splits audio at silences into OGG chunks of roughly TRANSCRIPTION_CHUNK_MS each.
+    CPU-bound; run it in a worker thread.
+
+    Args:
+        audio_bytes (bytes): The encoded audio in any format ffmpeg can read.
+
+    Returns:
+        list[bytes]: The encoded chunks in playback order, or an empty list if the
+            audio is too short to be worth splitting.
+    """
+    # Imported here so the bot still starts where pydub can't be imported
+    # (it needs audioop, which Python 3.13 dropped); callers fall back to whole files
+    from pydub import AudioSegment
+    from pydub.silence import split_on_silence
+
+    # Decode straight to 16 kHz mono: plenty for speech, and a fraction of the PCM to scan
+    segment = AudioSegment.from_file(io.BytesIO(audio_bytes), parameters=["-ac", "1", "-ar", "16000"])
+    if len(segment) <= TRANSCRIPTION_CHUNK_MS:
+        return []
+
+    # Probe for silence every SILENCE_SEEK_STEP_MS instead of every millisecond
+    pieces = split_on_silence(
+        segment,
+        min_silence_len=700,
+        silence_thresh=segment.dBFS - 16,
+        keep_silence=350,
+        seek_step=SILENCE_SEEK_STEP_MS,
     )
-    # end = time.time()
-    # full_text = ""
-    # async for event in transcription:
-    #     if hasattr(event, "delta"):
-    #         print(event.delta, end="", flush=True)
-    #         full_text += event.delta
-
-    # print("\n")
-    # print("-" * 25)
-    # print(f"Time taken: {end-start} seconds")
-    
-    return transcription.text
\ No newline at end of file
+
+    # Merge the speech pieces back into chunks of about the target length
+    chunks = []
+    current = AudioSegment.empty()
+    for piece in pieces:
+        current += piece
+        if len(current) >= TRANSCRIPTION_CHUNK_MS:
+            chunks.append(current)
+            current = AudioSegment.empty()
+    if len(current):
+        chunks.append(current)
+
+    encoded_chunks = []
+    for chunk in chunks:
+        buffer = io.BytesIO()
+        chunk.export(buffer, format="ogg", codec="libopus")
+        encoded_chunks.append(buffer.getvalue())
+    return encoded_chunks
+
+async def transcribe_chunk(chunk: bytes, prompt: str):
+    """
+    Transcribes one audio chunk, bounded by the shared transcription concurrency limit.
+
+    Args:
+        chunk (bytes): The OGG-encoded audio chunk.
+        prompt (str): Instructions guiding the transcription model.
+
+    Returns:
+        str: The transcribed text of the chunk.
+    """
+    async with transcription_semaphore:
+        return await transcribe(chunk, prompt)
+
+async def transcribe_audio(audio_file_path: str | bytes | BinaryIO):
+    """
+    Transcribes interview audio as an Interviewer/Applicant dialogue. Long recordings
+    are split at silences and the chunks are transcribed concurrently. Results are
+    cached on disk by a hash of the whole recording, checked before any splitting.
+
+    Args:
+        audio_file_path (str | bytes | BinaryIO): The recording, in any form
+            ``transcribe`` accepts.
+
+    Returns:
+        str: The transcribed text from the audio file.
+    """
+    if isinstance(audio_file_path, str):
+        audio_file_path = await read_audio_file(audio_file_path)
+
+    if isinstance(audio_file_path, (bytes, bytearray)):
+        audio_bytes = bytes(audio_file_path)
+    else:
+        audio_bytes = audio_file_path.read()
+        audio_file_path.seek(0)
+
+    cache_key = hashlib.blake2b(
+        audio_bytes + INTERVIEW_TRANSCRIPTION_PROMPT.encode(), digest_size=16
+    ).hexdigest()
+    try:
+        cached = await asyncio.to_thread(lookup_cached_transcription, cache_key)
+    except sqlite3.Error as e:
+        logger.warning(f"Transcription cache lookup failed: {str(e)}")
+        cached = None
+    if cached is not None:
+        logger.info("Transcription cache hit")
+        return cached
+
+    chunks = []
+    if len(audio_bytes) >= CHUNKED_TRANSCRIPTION_MIN_BYTES:
+        try:
+            chunks = await asyncio.to_thread(split_audio, audio_bytes)
+        except Exception as e:
+            logger.warning(f"Could not split audio, transcribing it whole: {str(e)}")
+
+    if len(chunks) > 1:
+        logger.info("Transcribing audio as %d concurrent chunks", len(chunks))
+        texts = await asyncio.gather(
+            *(transcribe_chunk(chunk, INTERVIEW_TRANSCRIPTION_PROMPT) for chunk in chunks)
+        )
+        transcript = "\n".join(texts)
+    else:
+        transcript = await transcribe(audio_file_path, INTERVIEW_TRANSCRIPTION_PROMPT)
+
+    try:
+        await asyncio.to_thread(store_cached_transcription, cache_key, transcript)
+    except sqlite3.Error as e:
+        logger.warning(f"Transcription cache write failed: {str(e)}")
+
+    return transcript
+
+# Voice queries are transcribed verbatim
+transcribe_voice = functools.partial(transcribe, prompt=VOICE_QUERY_TRANSCRIPTION_PROMPT)